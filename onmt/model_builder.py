@@ -124,7 +124,8 @@ class PadGen(nn.Module):
         return vals
         
 
-def build_base_model(model_opt, fields, gpu, checkpoint=None, gpu_id=None):
+def build_base_model(model_opt, fields, gpu, checkpoint=None, gpu_id=None,
+                     for_training=False):
     """Build a model from opts.
 
     Args:
@@ -137,6 +138,8 @@ def build_base_model(model_opt, fields, gpu, checkpoint=None, gpu_id=None):
         checkpoint: the model gnerated by train phase, or a resumed snapshot
                     model from a stopped training.
         gpu_id (int or NoneType): Which GPU to use.
+        for_training (bool): keep fp32 weights for mixed precision
+            training instead of casting an fp16 model to half.
 
     Returns:
         the NMTModel.
@@ -544,13 +547,15 @@ def build_base_model(model_opt, fields, gpu, checkpoint=None, gpu_id=None):
 
     model.generator = generator
     model.to(device)
-    if model_opt.model_dtype == 'fp16':
+    # Mixed precision training keeps fp32 weights, see Optimizer.
+    half = model_opt.model_dtype == 'fp16' and not for_training
+    if half:
         model.half()
 
     for p in model.parameters():
         if hasattr(p, 'orig'):
             p.orig = p.orig.to(device)
-            if model_opt.model_dtype == 'fp16':
+            if half:
                 p.orig = p.orig.half()
 
     return model
@@ -587,7 +592,8 @@ def emb_repr_patch(self):
 
 def build_model(model_opt, opt, fields, checkpoint):
     logger.info('Building model...')
-    model = build_base_model(model_opt, fields, use_gpu(opt), checkpoint)
+    model = build_base_model(model_opt, fields, use_gpu(opt), checkpoint,
+                             for_training=True)
 
     # Show which params will be updated
     nn.Linear.extra_repr = linear_repr_patch
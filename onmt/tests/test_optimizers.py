@@ -0,0 +1,270 @@
+import unittest
+from argparse import Namespace
+from math import sqrt
+
+import torch
+import torch.nn as nn
+import torch.optim as optim
+
+from onmt.decoders.transformer import TransformerDecoderLayer
+from onmt.utils.optimizers import MultipleOptimizer, AdaFactor, Optimizer, \
+    build_torch_optimizer
+
+
+class TestMultipleOptimizer(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.embeddings = nn.Embedding(10, 4, sparse=True)
+        self.linear = nn.Linear(4, 3)
+        self.dense = optim.Adam(self.linear.parameters())
+        self.sparse = optim.SparseAdam(self.embeddings.parameters())
+        self.optimizer = MultipleOptimizer([self.dense, self.sparse])
+
+    def _step(self):
+        self.optimizer.zero_grad()
+        out = self.linear(self.embeddings(torch.LongTensor([1, 2, 3])))
+        out.sum().backward()
+        self.optimizer.step()
+
+    def test_state_lookup_of_sparse_param(self):
+        self._step()
+        state = self.optimizer.state[self.embeddings.weight]
+        self.assertIn('exp_avg', state)
+        self.assertNotIn(self.embeddings.weight, self.dense.state)
+        # Would raise if the lookup leaked the parameter into Adam's state.
+        self.optimizer.state_dict()
+
+    def test_state_merges_all_optimizers(self):
+        self._step()
+        state = self.optimizer.state
+        for p in list(self.linear.parameters()) + [self.embeddings.weight]:
+            self.assertIn(p, state)
+
+    def test_state_is_rebuilt_after_step(self):
+        self.assertEqual(len(self.optimizer.state), 0)
+        self._step()
+        self.assertIn(self.embeddings.weight, self.optimizer.state)
+
+
+class TestOptimizerClipping(unittest.TestCase):
+
+    def test_clips_by_global_norm(self):
+        max_grad_norm = 1.0
+        first = nn.Parameter(torch.zeros(4))
+        second = nn.Parameter(torch.zeros(4))
+        sgd = optim.SGD([{'params': [first], 'factor': 1.0},
+                         {'params': [second], 'factor': 0.5}], lr=1.0)
+        optimizer = Optimizer(sgd, 1.0, max_grad_norm=max_grad_norm)
+        # Each group alone has norm 2.0, the total norm is 2.0 * sqrt(2).
+        first.grad = torch.full((4,), 1.0)
+        second.grad = torch.full((4,), 1.0)
+        optimizer.step()
+        total_norm = torch.cat([first.grad, second.grad]).norm().item()
+        self.assertAlmostEqual(total_norm, max_grad_norm, places=5)
+        # Per-group clipping would have left each group at max_grad_norm.
+        self.assertAlmostEqual(first.grad.norm().item(),
+                               max_grad_norm / sqrt(2), places=5)
+
+
+class _TinyDecoder(nn.Module):
+    def __init__(self, d_model, n_layers):
+        super(_TinyDecoder, self).__init__()
+        self.embeddings = nn.Embedding(10, d_model)
+        self.transformer_layers = nn.ModuleList(
+            [TransformerDecoderLayer(d_model, 2, 8, 0.0, 0.0)
+             for _ in range(n_layers)])
+        self.layer_norm = nn.LayerNorm(d_model)
+
+
+class _TinyModel(nn.Module):
+    def __init__(self, d_model=4, n_layers=2):
+        super(_TinyModel, self).__init__()
+        self.encoder = nn.Linear(d_model, d_model)
+        self.decoder = _TinyDecoder(d_model, n_layers)
+        self.generator = nn.Sequential(nn.Linear(d_model, 10))
+        # Tied output projection, claimed by the generator group first.
+        self.generator[0].weight = self.decoder.embeddings.weight
+
+
+class TestBuildTorchOptimizer(unittest.TestCase):
+    N_LAYERS = 2
+
+    @classmethod
+    def opt(cls, **kwargs):
+        opt = dict(
+            optim='adam', disc_ft=2.0, dec_lr_factor=1.0,
+            dec_layers=cls.N_LAYERS, decoder_type='transformer',
+            full_context_lr=False, share_decoder_embeddings=False,
+            share_embeddings=False, encdec_share_params=False,
+            simple_fusion=False, copy_attn=False, full_gen_bias=False,
+            learning_rate=1.0, adam_beta1=0.9, adam_beta2=0.998,
+            model_dtype='fp32')
+        opt.update(kwargs)
+        return Namespace(**opt)
+
+    def group_ids(self, optimizer):
+        return [[id(p) for p in group['params']]
+                for group in optimizer.param_groups]
+
+    def test_no_parameter_in_two_groups(self):
+        model = _TinyModel(n_layers=self.N_LAYERS)
+        optimizer = build_torch_optimizer(model, self.opt())
+        ids = sum(self.group_ids(optimizer), [])
+        self.assertEqual(len(ids), len(set(ids)))
+        self.assertEqual(set(ids), set(id(p) for p in model.parameters()))
+        # The tied weight keeps the generator group's factor.
+        top_group = optimizer.param_groups[1]
+        self.assertIn(id(model.generator[0].weight),
+                      [id(p) for p in top_group['params']])
+
+    def test_frozen_parameters_are_left_out(self):
+        model = _TinyModel(n_layers=self.N_LAYERS)
+        for p in model.decoder.transformer_layers[0].parameters():
+            p.requires_grad = False
+        optimizer = build_torch_optimizer(model, self.opt())
+        ids = set(sum(self.group_ids(optimizer), []))
+        for p in model.decoder.transformer_layers[0].parameters():
+            self.assertNotIn(id(p), ids)
+        # The emptied layer group is dropped rather than kept empty, and so
+        # is the embeddings group, whose only weight the generator claims.
+        for group in optimizer.param_groups:
+            self.assertTrue(group['params'])
+        self.assertEqual(len(optimizer.param_groups),
+                         2 + (self.N_LAYERS - 1))
+
+    def test_full_context_lr_puts_context_in_top_group(self):
+        model = _TinyModel(n_layers=self.N_LAYERS)
+        optimizer = build_torch_optimizer(
+            model, self.opt(full_context_lr=True))
+        groups = self.group_ids(optimizer)
+        ids = sum(groups, [])
+        self.assertEqual(len(ids), len(set(ids)))
+        context_ids = [id(p) for name, p in model.decoder.named_parameters()
+                       if 'context' in name]
+        self.assertTrue(context_ids)
+        # Groups: encoder, top (generator, layer norm, context), layers,
+        # embeddings.
+        for context_id in context_ids:
+            self.assertIn(context_id, groups[1])
+
+
+def _reference_rms(x):
+    return sqrt(torch.mean(x.pow(2)))
+
+
+def _reference_adafactor_step(params, states, group):
+    """Per-parameter AdaFactor update as it was written before the update
+    was bucketed and scripted. Factored AMSGrad keeps the maxima of the row
+    and column statistics rather than of the full second moment.
+    """
+    for p in params:
+        grad = p.grad.data
+        is_matrix = grad.dim() >= 2
+        is_factored = is_matrix and group['enable_factorization']
+        new_shape = old_shape = p.data.size()
+        if grad.dim() > 2 and group['enable_factorization']:
+            new_shape, old_shape = \
+                AdaFactor._experimental_reshape(p.data.size())
+            grad = grad.view(new_shape)
+
+        state = states.setdefault(p, {})
+        if len(state) == 0:
+            state['step'] = 0
+            if group['enable_momentum']:
+                state['exp_avg'] = torch.zeros(new_shape)
+            if is_factored:
+                state['exp_avg_sq_R'] = torch.zeros((1, new_shape[1]))
+                state['exp_avg_sq_C'] = torch.zeros((new_shape[0], 1))
+                if group['ams_grad']:
+                    state['exp_avg_sq_R_hat'] = torch.zeros((1, new_shape[1]))
+                    state['exp_avg_sq_C_hat'] = torch.zeros((new_shape[0], 1))
+            else:
+                state['exp_avg_sq'] = torch.zeros(new_shape)
+                if group['ams_grad']:
+                    state['exp_avg_sq_hat'] = torch.zeros(new_shape)
+
+        state['step'] += 1
+        step = state['step']
+        lr_t = group['lr'] * max(group['eps2'], _reference_rms(p.data))
+
+        def decay(beta):
+            if group['non_constant_decay']:
+                return beta * (1 - beta ** (step - 1)) / (1 - beta ** step)
+            return beta
+
+        if group['enable_momentum']:
+            beta1_t = decay(group['beta1'])
+            state['exp_avg'].mul_(beta1_t).add_(grad, alpha=1 - beta1_t)
+        beta2_t = decay(group['beta2'])
+
+        if is_factored:
+            g2 = grad * grad + group['eps1']
+            r = state['exp_avg_sq_R']
+            c = state['exp_avg_sq_C']
+            r.mul_(beta2_t).add_(g2.sum(dim=0, keepdim=True),
+                                 alpha=1 - beta2_t)
+            c.mul_(beta2_t).add_(g2.sum(dim=1, keepdim=True),
+                                 alpha=1 - beta2_t)
+            if group['ams_grad']:
+                r = torch.max(state['exp_avg_sq_R_hat'], r,
+                              out=state['exp_avg_sq_R_hat'])
+                c = torch.max(state['exp_avg_sq_C_hat'], c,
+                              out=state['exp_avg_sq_C_hat'])
+            v = c * r / r.sum()
+        else:
+            v = state['exp_avg_sq']
+            v.mul_(beta2_t).addcmul_(grad, grad, value=1 - beta2_t) \
+                .add_((1 - beta2_t) * group['eps1'])
+            if group['ams_grad']:
+                v = torch.max(state['exp_avg_sq_hat'], v,
+                              out=state['exp_avg_sq_hat'])
+
+        g = grad
+        if group['enable_momentum']:
+            g = state['exp_avg'] / (1 - beta1_t ** step)
+
+        if group['ams_grad']:
+            u = g / ((v / (1 - beta2_t ** step)).sqrt() + group['eps1'])
+        else:
+            u = g / v.sqrt()
+
+        u.div_(max(1, _reference_rms(u) / group['cliping_threshold']))
+        p.data.add_(-lr_t * u.view(old_shape))
+        if group['weight_decay'] != 0:
+            p.data.add_(p.data, alpha=-group['weight_decay'] * lr_t)
+
+
+class TestAdaFactor(unittest.TestCase):
+    # Dense vector, matrix, and two shapes reshaped for factorization.
+    SHAPES = [(7,), (5, 6), (3, 4, 5), (2, 3, 4, 5)]
+    CASES = [
+        dict(),
+        dict(weight_decay=0.1),
+        dict(beta1=0),
+        dict(enable_factorization=False),
+        dict(non_constant_decay=False, ams_grad=True, weight_decay=0.1),
+        dict(non_constant_decay=False, ams_grad=True,
+             enable_factorization=False),
+    ]
+    N_STEPS = 5
+
+    def test_matches_reference_update(self):
+        for case in self.CASES:
+            torch.manual_seed(1)
+            params = [nn.Parameter(torch.randn(shape))
+                      for shape in self.SHAPES]
+            ref_params = [nn.Parameter(p.data.clone()) for p in params]
+            optimizer = AdaFactor(params, lr=0.01, **case)
+            group = optimizer.param_groups[0]
+            ref_states = {}
+            for _ in range(self.N_STEPS):
+                for p, ref_p in zip(params, ref_params):
+                    p.grad = torch.randn(p.size())
+                    ref_p.grad = p.grad.clone()
+                optimizer.step()
+                _reference_adafactor_step(ref_params, ref_states, group)
+            for p, ref_p in zip(params, ref_params):
+                self.assertTrue(
+                    torch.allclose(p.data, ref_p.data, rtol=1e-4, atol=1e-6),
+                    "%s %s" % (case, tuple(p.size())))
@@ -114,6 +114,9 @@ class Trainer(object):
         self.average_every = average_every
         self.model_dtype = model_dtype
         self.gpt2_params_std = gpt2_params_std
+        # Mixed precision keeps fp32 weights and runs the forward pass
+        # under autocast.
+        self.amp = model_dtype == 'fp16'
 
         assert grad_accum_count > 0
         if grad_accum_count > 1:
@@ -273,8 +276,7 @@ class Trainer(object):
             valid_model = deepcopy(self.model)
             for avg, param in zip(self.moving_average,
                                   valid_model.parameters()):
-                param.data = avg.data.half() if self.model_dtype == "fp16" \
-                    else avg.data
+                param.data = avg.data
         else:
             valid_model = self.model
 
@@ -296,12 +298,13 @@ class Trainer(object):
                     src, src_lengths = batch.src if isinstance(batch.src, tuple) \
                                        else (batch.src, None)
 
-                # F-prop through the model.
-                outputs, attns = valid_model(src, tgt, src_lengths, 
-                                             tgt_lengths=tgt_lengths)
+                with torch.cuda.amp.autocast(enabled=self.amp):
+                    # F-prop through the model.
+                    outputs, attns = valid_model(src, tgt, src_lengths, 
+                                                 tgt_lengths=tgt_lengths)
 
-                # Compute loss.
-                _, batch_stats = self.valid_loss(batch, outputs, attns)
+                    # Compute loss.
+                    _, batch_stats = self.valid_loss(batch, outputs, attns)
 
                 # Update statistics.
                 stats.update(batch_stats)
@@ -354,18 +357,19 @@ class Trainer(object):
                 if self.grad_accum_count == 1:
                     self.optim.zero_grad()
 
-                outputs, attns = self.model(src, tgt, src_lengths, bptt=bptt, tgt_lengths=tgt_lengths)
-                bptt = True
+                with torch.cuda.amp.autocast(enabled=self.amp):
+                    outputs, attns = self.model(src, tgt, src_lengths, bptt=bptt, tgt_lengths=tgt_lengths)
+                    bptt = True
 
-                # 3. Compute loss.
-                loss, batch_stats = self.train_loss(
-                    batch,
-                    outputs,
-                    attns,
-                    normalization=normalization,
-                    shard_size=self.shard_size,
-                    trunc_start=j,
-                    trunc_size=trunc_size)
+                    # 3. Compute loss.
+                    loss, batch_stats = self.train_loss(
+                        batch,
+                        outputs,
+                        attns,
+                        normalization=normalization,
+                        shard_size=self.shard_size,
+                        trunc_start=j,
+                        trunc_size=trunc_size)
 
                 if loss is not None:
                     self.optim.backward(loss)
@@ -382,11 +386,7 @@ class Trainer(object):
                 if self.grad_accum_count == 1:
                     # Multi GPU gradient gather
                     if self.n_gpu > 1:
-                        grads = [p.grad.data for p in self.model.parameters()
-                                 if p.requires_grad
-                                 and p.grad is not None]
-                        onmt.utils.distributed.all_reduce_and_rescale_tensors(
-                            grads, float(1))
+                        self._all_reduce_grads()
                     self.optim.step()
 
                 # If truncated, don't backprop fully.
@@ -400,13 +400,26 @@ class Trainer(object):
         # update only after accum batches
         if self.grad_accum_count > 1:
             if self.n_gpu > 1:
-                grads = [p.grad.data for p in self.model.parameters()
-                         if p.requires_grad
-                         and p.grad is not None]
-                onmt.utils.distributed.all_reduce_and_rescale_tensors(
-                    grads, float(1))
+                self._all_reduce_grads()
             self.optim.step()
 
+    def _all_reduce_grads(self):
+        """Sums the gradients of all trainable parameters across GPUs.
+
+        Every rank must reduce the same list of tensors, so gradients
+        freed by `zero_grad` or missing from this step's graph are
+        reduced as zeros.
+        """
+        grads = []
+        for p in self.model.parameters():
+            if not p.requires_grad:
+                continue
+            if p.grad is None:
+                p.grad = torch.zeros_like(p)
+            grads.append(p.grad.data)
+        onmt.utils.distributed.all_reduce_and_rescale_tensors(
+            grads, float(1))
+
     def _start_report_manager(self, start_time=None):
         """
         Simple function to start report manager (if any)
@@ -120,3 +120,11 @@ def all_gather_list(data, max_size=4096):
         result = pickle.loads(bytes_list)
         results.append(result)
     return results
+
+
+def broadcast_object(data, src=0):
+    """Broadcasts picklable data from rank `src` to all nodes and returns
+    it."""
+    objects = [data]
+    torch.distributed.broadcast_object_list(objects, src=src)
+    return objects[0]
@@ -1,4 +1,5 @@
 """ Optimizers class """
+import numpy as np
 import torch
 import torch.optim as optim
 from torch.nn.utils import clip_grad_norm_
@@ -8,6 +9,8 @@ from copy import copy
 from math import sqrt
 
 from onmt.utils.misc import fn_args
+from onmt.utils.distributed import broadcast_object
+from onmt.utils.logging import logger
 
 
 def build_torch_optimizer(model, opt):
@@ -74,10 +77,24 @@ def build_torch_optimizer(model, opt):
                     enc_params = []
 
             decoder = model.decoder
+
+            # A parameter may only belong to one group: the first group that
+            # claims it keeps it, later selectors skip it. Frozen parameters
+            # are left out, and so are groups left empty.
+            param_groups = []
+            seen_ids = set()
+
+            def add_group(params, factor):
+                group_params = []
+                for p in params:
+                    if p.requires_grad and id(p) not in seen_ids:
+                        seen_ids.add(id(p))
+                        group_params.append(p)
+                if group_params:
+                    param_groups.append({'params': group_params, 'factor': factor})
+
             if enc_params:
-                param_groups = [{'params': enc_params, 'factor': 1.0}]
-            else:
-                param_groups = []
+                add_group(enc_params, 1.0)
 
             # Making a choice here to use smaller learning rate for generator weight if 
             # using shared decoder embeddings
@@ -86,42 +103,37 @@ def build_torch_optimizer(model, opt):
                     gen_params = [model.generator[0].bias]
                 else:
                     if opt.copy_attn:
-                        gen_params = [p for p in model.generator.linear_copy.parameters()]
+                        gen_params = list(model.generator.linear_copy.parameters())
                     else:
                         gen_params = []
             else:
-                gen_params = model.generator.parameters()
+                gen_params = list(model.generator.parameters())
 
             params_end = [*gen_params, *decoder.layer_norm.parameters()]
 
             if opt.full_context_lr:
+                # Context parameters of every layer go to this group, so the
+                # per-layer groups below skip them.
                 params_end += [p for name, p in decoder.named_parameters() if 'context' in name or 'ctx' in name]
 
             factor = 1.0/opt.dec_lr_factor
-            param_groups.append({'params': params_end, 'factor': factor})
+            add_group(params_end, factor)
             for layer_num in range(opt.dec_layers-1, -1, -1):
                 factor /= opt.disc_ft
-                if opt.full_context_lr:
-                     layer_params = [p for name, p in decoder.transformer_layers[layer_num].named_parameters() if 'context' not in name and 'ctx' not in name]
-                else:
-                     layer_params = [p for p in decoder.transformer_layers[layer_num].parameters()]
-
-                param_groups.append({'params': layer_params, 'factor': factor})
+                add_group(decoder.transformer_layers[layer_num].parameters(), factor)
 
             factor /= opt.disc_ft
-            emb_params = [p for p in decoder.embeddings.parameters()]
+            emb_params = list(decoder.embeddings.parameters())
             if opt.share_decoder_embeddings and not opt.full_gen_bias:
                 if opt.copy_attn:
                     emb_params.append(model.generator.linear.bias)
                 else:
                     emb_params.append(model.generator[0].bias)
-            param_groups.append({'params': emb_params, 'factor': factor})
+            add_group(emb_params, factor)
 
             num_params = 0
             for group in param_groups:
                 for p in group['params']:
-                    if not p.requires_grad:
-                        continue
                     num_params += p.nelement()
 
             print('num params for optimizer: %d' % num_params)
@@ -166,53 +178,61 @@ def build_torch_optimizer(model, opt):
     else:
         raise ValueError('Invalid optimizer type: ' + opt.optim)
 
-    if opt.model_dtype == 'fp16':
-        import apex
-        static_loss_scale = opt.loss_scale
-        dynamic_loss_scale = opt.loss_scale == 0
-        # TODO: clean this up when APEX unify its optimizer API.
-        if opt.optim.startswith('fused'):
-            namespace = apex.optimizers  # Faster wrapper.
-        else:
-            namespace = apex.fp16_utils
-        optimizer = namespace.FP16_Optimizer(
-            optimizer,
-            static_loss_scale=static_loss_scale,
-            dynamic_loss_scale=dynamic_loss_scale)
     return optimizer
 
 
 def make_learning_rate_decay_fn(opt):
     """Returns the learning decay function from options."""
     if opt.decay_method == 'noam':
-        return functools.partial(
+        decay_fn = functools.partial(
             noam_decay,
-            warmup_steps=opt.warmup_steps,
-            model_size=opt.rnn_size)
+            warmup_steps_neg_1_5=opt.warmup_steps ** (-1.5),
+            model_size_neg_0_5=opt.rnn_size ** (-0.5))
     elif opt.decay_method == 'rsqrt':
-        return functools.partial(
+        decay_fn = functools.partial(
             rsqrt_decay, warmup_steps=opt.warmup_steps)
     elif opt.decay_method == 'stlr':
         if opt.warmup_steps > opt.train_steps:
             raise ValueError('warmup_steps should be smaller than train_steps')
-        return functools.partial(
+        decay_fn = functools.partial(
             stlr_decay, warmup_steps=opt.warmup_steps,
             train_steps=opt.train_steps, ratio=opt.stlr_ratio)
     elif opt.decay_method == 'invsq':
-        return functools.partial(
+        decay_fn = functools.partial(
             invsq_decay,
             warmup_steps=opt.warmup_steps,
-            warmup_init_factor=opt.warmup_init_factor)
+            inv_warmup_init_factor=1.0 / opt.warmup_init_factor)
     elif opt.start_decay_steps is not None:
-        return functools.partial(
+        decay_fn = functools.partial(
             exponential_decay,
             rate=opt.learning_rate_decay,
             decay_steps=opt.decay_steps,
             start_step=opt.start_decay_steps)
+    else:
+        return None
+
+    if opt.train_steps > 0:
+        # The schedule only depends on the step, so it is computed upfront.
+        table = np.empty(opt.train_steps, dtype=np.float64)
+        for step in range(1, opt.train_steps + 1):
+            table[step - 1] = decay_fn(step)
+        return functools.partial(
+            tabulated_decay, table=table, decay_fn=decay_fn)
+    return decay_fn
 
-def invsq_decay(step, warmup_steps, warmup_init_factor):
+
+def tabulated_decay(step, table, decay_fn):
+    """Looks up the scale of :obj:`step` in a precomputed schedule,
+    falling back to :obj:`decay_fn` for steps past its end.
+    """
+    if 1 <= step <= len(table):
+        return float(table[step - 1])
+    return decay_fn(step)
+
+
+def invsq_decay(step, warmup_steps, inv_warmup_init_factor):
     if step < warmup_steps:
-        return 1.0/warmup_init_factor + (1 - 1.0/warmup_init_factor)/warmup_steps*step
+        return inv_warmup_init_factor + (1 - inv_warmup_init_factor)/warmup_steps*step
     else:
         return (warmup_steps/step)**0.5
 
@@ -222,13 +242,15 @@ def stlr_decay(step, warmup_steps, train_steps, ratio):
     p = min(step/cut, 1 - (step-cut)/(cut*(1/cut_frac-1)))
     return (1 + p*(ratio-1))/ratio
 
-def noam_decay(step, warmup_steps, model_size):
+def noam_decay(step, warmup_steps_neg_1_5, model_size_neg_0_5):
     """Learning rate schedule described in
     https://arxiv.org/pdf/1706.03762.pdf.
+
+    Takes ``warmup_steps ** -1.5`` and ``model_size ** -0.5`` precomputed.
     """
     return (
-        model_size ** (-0.5) *
-        min(step ** (-0.5), step * warmup_steps**(-1.5)))
+        model_size_neg_0_5 *
+        min(step ** (-0.5), step * warmup_steps_neg_1_5))
 
 
 def exponential_decay(step, rate, decay_steps, start_step=0):
@@ -243,34 +265,56 @@ def rsqrt_decay(step, warmup_steps):
     return 1.0 / sqrt(max(step, warmup_steps))
 
 
+def _zero_grad_fn(optimizer):
+    """Returns a callable that frees the gradients instead of zeroing them
+    when the optimizer supports it, which saves a full write over the
+    gradients.
+    """
+    if "set_to_none" in fn_args(optimizer.zero_grad):
+        return functools.partial(optimizer.zero_grad, set_to_none=True)
+    return optimizer.zero_grad
+
+
 class MultipleOptimizer(object):
     """ Implement multiple optimizers needed for sparse adam """
 
     def __init__(self, op):
         """ ? """
         self.optimizers = op
+        self._zero_grad_fns = [_zero_grad_fn(optimizer) for optimizer in op]
+        self._param_groups = None
+        self._state = None
 
     @property
     def param_groups(self):
-        param_groups = []
-        for optimizer in self.optimizers:
-            param_groups.extend(optimizer.param_groups)
-        return param_groups
+        # Cached, the groups only change when a state dict is loaded.
+        if self._param_groups is None:
+            self._param_groups = []
+            for optimizer in self.optimizers:
+                self._param_groups.extend(optimizer.param_groups)
+        return self._param_groups
 
     def zero_grad(self):
         """ ? """
-        for op in self.optimizers:
-            op.zero_grad()
+        for zero_grad in self._zero_grad_fns:
+            zero_grad()
 
     def step(self):
         """ ? """
         for op in self.optimizers:
             op.step()
+        # Steps may add state for parameters seen for the first time.
+        self._state = None
 
     @property
     def state(self):
         """ ? """
-        return {k: v for op in self.optimizers for k, v in op.state.items()}
+        # Cached, the per-parameter state dicts are shared with the wrapped
+        # optimizers so only new keys require a rebuild.
+        if self._state is None:
+            self._state = {k: v for op in self.optimizers
+                           for k, v in op.state.items()}
+        return self._state
 
     def state_dict(self):
         """ ? """
@@ -281,6 +325,8 @@ class MultipleOptimizer(object):
         assert len(state_dicts) == len(self.optimizers)
         for i in range(len(state_dicts)):
             self.optimizers[i].load_state_dict(state_dicts[i])
+        self._param_groups = None
+        self._state = None
 
 
 class Optimizer(object):
@@ -296,7 +342,8 @@ class Optimizer(object):
                  optimizer,
                  learning_rate,
                  learning_rate_decay_fn=None,
-                 max_grad_norm=None):
+                 max_grad_norm=None,
+                 loss_scale=None):
         """Initializes the controller.
 
        Args:
@@ -305,15 +352,28 @@ class Optimizer(object):
          learning_rate_decay_fn: An optional callable taking the current step
            as argument and return a learning rate scaling factor.
          max_grad_norm: Clip gradients to this global norm.
+         loss_scale: Enables mixed precision training with a
+           ``torch.cuda.amp.GradScaler`` if not ``None``. A value of 0 scales
+           the loss dynamically, a positive value is used as a static scale.
         """
         self._optimizer = optimizer
+        self._zero_grad = _zero_grad_fn(optimizer)
         self._learning_rate = learning_rate
         self._learning_rate_decay_fn = learning_rate_decay_fn
         self._max_grad_norm = max_grad_norm or 0
         self._training_step = 1
         self._decay_step = 1
-        self._with_fp16_wrapper = (
-            optimizer.__class__.__name__ == "FP16_Optimizer")
+        self._cached_lr = None
+        self._cached_step = -1
+        self._last_lr = None
+        self._clip_params = None
+        self._scaler = None
+        self._static_loss_scale = None
+        if loss_scale is not None:
+            self._scaler = torch.cuda.amp.GradScaler(
+                init_scale=loss_scale or 2.**16)
+            if loss_scale > 0:
+                self._static_loss_scale = loss_scale
 
     @classmethod
     def from_opt(cls, model, opt, checkpoint=None):
@@ -362,7 +422,9 @@ class Optimizer(object):
             build_torch_optimizer(model, optim_opt),
             optim_opt.learning_rate,
             learning_rate_decay_fn=make_learning_rate_decay_fn(optim_opt),
-            max_grad_norm=optim_opt.max_grad_norm)
+            max_grad_norm=optim_opt.max_grad_norm,
+            loss_scale=(optim_opt.loss_scale
+                        if optim_opt.model_dtype == 'fp16' else None))
         if optim_state_dict:
             optimizer.load_state_dict(optim_state_dict)
         return optimizer
@@ -376,36 +438,64 @@ class Optimizer(object):
         """Returns the current learning rate."""
         if self._learning_rate_decay_fn is None:
             return self._learning_rate
-        scale = self._learning_rate_decay_fn(self._decay_step)
-        return scale * self._learning_rate
+        if self._cached_step != self._decay_step:
+            scale = self._learning_rate_decay_fn(self._decay_step)
+            self._cached_lr = scale * self._learning_rate
+            self._cached_step = self._decay_step
+        return self._cached_lr
 
     def state_dict(self):
-        return {
+        state_dict = {
             'training_step': self._training_step,
             'decay_step': self._decay_step,
             'optimizer': self._optimizer.state_dict()
         }
+        if self._scaler is not None:
+            state_dict['scaler'] = self._scaler.state_dict()
+        return state_dict
 
     def load_state_dict(self, state_dict):
+        if torch.distributed.is_available() and \
+                torch.distributed.is_initialized():
+            # All ranks must resume from the same optimizer state, so take
+            # the one loaded by the first rank.
+            state_dict = broadcast_object(state_dict, src=0)
         self._training_step = state_dict['training_step']
         # State can be partially restored.
         if 'decay_step' in state_dict:
             self._decay_step = state_dict['decay_step']
-        if 'optimizer' in state_dict:
-            self._optimizer.load_state_dict(state_dict['optimizer'])
+        optimizer_state_dict = state_dict.get('optimizer')
+        if isinstance(optimizer_state_dict, dict) and \
+                'fp32_groups_flat' in optimizer_state_dict:
+            # apex.optimizers.FP16_Optimizer flattened every param group
+            # into a single tensor, its state cannot be mapped back.
+            logger.warning('Optimizer state saved by apex FusedAdam FP16 '
+                           'training cannot be restored, resetting it as '
+                           'with -reset_optim states.')
+            optimizer_state_dict = None
+        elif isinstance(optimizer_state_dict, dict) and \
+                'optimizer_state_dict' in optimizer_state_dict:
+            # Checkpoint written through apex.fp16_utils.FP16_Optimizer,
+            # which wraps the state of the optimizer it drives.
+            optimizer_state_dict = \
+                optimizer_state_dict['optimizer_state_dict']
+        if optimizer_state_dict is not None:
+            self._optimizer.load_state_dict(optimizer_state_dict)
+            # The loaded param groups carry the checkpoint learning rates.
+            self._last_lr = None
+            self._clip_params = None
+        if self._scaler is not None and 'scaler' in state_dict:
+            self._scaler.load_state_dict(state_dict['scaler'])
 
     def zero_grad(self):
         """Zero the gradients of optimized parameters."""
-        self._optimizer.zero_grad()
+        self._zero_grad()
 
     def backward(self, loss):
-        """Wrapper for backward pass. Some optimizer requires ownership of the
-        backward pass."""
-        if self._with_fp16_wrapper:
-            kwargs = {}
-            if "update_master_grads" in fn_args(self._optimizer.backward):
-                kwargs["update_master_grads"] = True
-            self._optimizer.backward(loss, **kwargs)
+        """Wrapper for backward pass. The loss is scaled first when training
+        in mixed precision."""
+        if self._scaler is not None:
+            self._scaler.scale(loss).backward()
         else:
             loss.backward()
 
@@ -413,26 +503,99 @@ class Optimizer(object):
         """Update the model parameters based on current gradients.
 
         Optionally, will employ gradient modification or update learning
-        rate.
+        rate. Without clipping and while the learning rate is unchanged,
+        the param groups are not visited at all.
         """
         learning_rate = self.learning_rate()
-        if self._with_fp16_wrapper:
-            if hasattr(self._optimizer, "update_master_grads"):
-                self._optimizer.update_master_grads()
-            if hasattr(self._optimizer, "clip_master_grads") and \
-               self._max_grad_norm > 0:
-                self._optimizer.clip_master_grads(self._max_grad_norm)
-        for group in self._optimizer.param_groups:
-            if 'factor' in group:
-                group['lr'] = group['factor']*learning_rate
-            else:
-                group['lr'] = learning_rate
-            if not self._with_fp16_wrapper and self._max_grad_norm > 0:
-                clip_grad_norm_(group['params'], self._max_grad_norm)
-        self._optimizer.step()
+        if self._scaler is not None:
+            # Gradients must be unscaled before being clipped.
+            self._scaler.unscale_(self._optimizer)
+        if self._max_grad_norm > 0:
+            if self._clip_params is None:
+                self._clip_params = [p for group in self._optimizer.param_groups
+                                     for p in group['params']]
+            clip_grad_norm_(self._clip_params, self._max_grad_norm)
+        if learning_rate != self._last_lr:
+            # Group learning rates only need refreshing when the schedule
+            # moves.
+            for group in self._optimizer.param_groups:
+                group['lr'] = group.get('factor', 1.0)*learning_rate
+            self._last_lr = learning_rate
+        if self._scaler is not None:
+            # Skips the update if the gradients overflowed.
+            self._scaler.step(self._optimizer)
+            self._scaler.update(self._static_loss_scale)
+        else:
+            self._optimizer.step()
         self._decay_step += 1
         self._training_step += 1
 
+
+def _multi_tensor_decay_(tensors, others, beta, square=False, eps=0):
+    """Exponential moving average ``t = beta * t + (1 - beta) * o`` over
+    lists of tensors, in place. With :obj:`square`, ``o * o + eps`` is
+    averaged instead. Uses the fused multi-tensor ``torch._foreach_*``
+    kernels when available, and a per-tensor loop otherwise.
+    """
+    if not tensors:
+        return
+    if hasattr(torch, '_foreach_mul_'):
+        torch._foreach_mul_(tensors, beta)
+        if square:
+            torch._foreach_addcmul_(tensors, others, others, value=1 - beta)
+            torch._foreach_add_(tensors, (1 - beta) * eps)
+        else:
+            torch._foreach_add_(tensors, others, alpha=1 - beta)
+    else:
+        for t, o in zip(tensors, others):
+            t.mul_(beta)
+            if square:
+                t.addcmul_(o, o, value=1 - beta).add_((1 - beta) * eps)
+            else:
+                t.add_(o, alpha=1 - beta)
+
+
+# The element-wise tail of the AdaFactor update is scripted so that the
+# TorchScript fuser can merge it into few kernels per parameter.
+
+
+@torch.jit.script
+def _rms(x):
+    # Kept as a 0-d tensor to avoid a device sync per call.
+    return x.norm() * (x.numel() ** -0.5)
+
+
+@torch.jit.script
+def _adafactor_apply(p, u, lr: float, eps2: float, cliping_threshold: float,
+                     weight_decay: float):
+    """Clips the update :obj:`u` and applies it to :obj:`p` in place."""
+    lr_t = lr * torch.clamp(_rms(p), min=eps2)
+    u = u / torch.clamp(_rms(u) / cliping_threshold, min=1.0)
+    # lr_t is a 0-d tensor, so addcmul_ avoids a scaled copy of u.
+    p.addcmul_(u.view(p.size()), lr_t, value=-1.0)
+    if weight_decay != 0:
+        # Decoupled weight decay as a single in-place scaling.
+        p.mul_(1.0 - weight_decay * lr_t)
+
+
+@torch.jit.script
+def _adafactor_update_factored(p, g, exp_avg_sq_r, exp_avg_sq_c, lr: float,
+                               eps2: float, cliping_threshold: float,
+                               weight_decay: float):
+    # v = c * r / sum(r), so g / sqrt(v) can be computed by broadcasting
+    # without materializing v.
+    u = g * exp_avg_sq_c.rsqrt() * exp_avg_sq_r.rsqrt() * \
+        torch.sum(exp_avg_sq_r).sqrt()
+    _adafactor_apply(p, u, lr, eps2, cliping_threshold, weight_decay)
+
+
+@torch.jit.script
+def _adafactor_update_dense(p, g, exp_avg_sq, lr: float, eps2: float,
+                            cliping_threshold: float, weight_decay: float):
+    u = g / exp_avg_sq.sqrt()
+    _adafactor_apply(p, u, lr, eps2, cliping_threshold, weight_decay)
+
+
 # Code below is an implementation of https://arxiv.org/pdf/1804.04235.pdf
 # inspired but modified from https://github.com/DeadAt0m/adafactor-pytorch
 
@@ -460,7 +623,8 @@ class AdaFactor(torch.optim.Optimizer):
     def __setstate__(self, state):
         super(AdaFactor, self).__setstate__(state)
 
-    def _experimental_reshape(self, shape):
+    @staticmethod
+    def _experimental_reshape(shape):
         temp_shape = shape[2:]
         if len(temp_shape) == 1:
             new_shape = (shape[0], shape[1]*shape[2])
@@ -486,14 +650,28 @@ class AdaFactor(torch.optim.Optimizer):
         else:
             return False, False
 
-    def _rms(self, x):
-        return sqrt(torch.mean(x.pow(2)))
+    def _decay_rates(self, group, step):
+        """Returns ``(beta1_t, beta2_t, bias_correction1, bias_correction2)``
+        for :obj:`step`. These only depend on the group and the step, so
+        they are computed once for all parameters sharing a step.
+        """
+        def decay(beta):
+            if group['non_constant_decay']:
+                return beta * (1 - beta ** (step - 1)) / (1 - beta ** step)
+            return beta
+        beta1_t = decay(group['beta1']) if group['enable_momentum'] else 0
+        beta2_t = decay(group['beta2'])
+        return (beta1_t, beta2_t,
+                1.0 / (1 - beta1_t ** step), 1.0 / (1 - beta2_t ** step))
 
     def step(self, closure=None):
         loss = None
         if closure is not None:
             loss = closure()
         for group in self.param_groups:
+            # Parameters are bucketed by (step, factored) so that the
+            # moment updates can be applied as multi-tensor ops.
+            buckets = {}
             for p in group['params']:
                 if p.grad is None:
                     continue
@@ -504,10 +682,10 @@ class AdaFactor(torch.optim.Optimizer):
                                        gradients, use SparseAdam instead')
 
                 is_matrix, is_need_reshape = self._check_shape(grad.size())
+                is_factored = is_matrix and group['enable_factorization']
                 new_shape = p.data.size()
                 if is_need_reshape and group['enable_factorization']:
-                    new_shape, old_shape = \
-                        self._experimental_reshape(p.data.size())
+                    new_shape, _ = self._experimental_reshape(p.data.size())
                     grad = grad.view(new_shape)
 
                 state = self.state[p]
@@ -518,7 +696,7 @@ class AdaFactor(torch.optim.Optimizer):
                                                        dtype=torch.float32,
                                                        device=p.grad.device)
 
-                    if is_matrix and group['enable_factorization']:
+                    if is_factored:
                         state['exp_avg_sq_R'] = \
                             torch.zeros((1, new_shape[1]),
                                         dtype=torch.float32,
@@ -532,76 +710,83 @@ class AdaFactor(torch.optim.Optimizer):
                                                           dtype=torch.float32,
                                                           device=p.grad.device)
                     if group['ams_grad']:
-                        state['exp_avg_sq_hat'] = \
-                            torch.zeros(new_shape, dtype=torch.float32,
-                                        device=p.grad.device)
-
-                if group['enable_momentum']:
-                    exp_avg = state['exp_avg']
-
-                if is_matrix and group['enable_factorization']:
-                    exp_avg_sq_r = state['exp_avg_sq_R']
-                    exp_avg_sq_c = state['exp_avg_sq_C']
-                else:
-                    exp_avg_sq = state['exp_avg_sq']
-
-                if group['ams_grad']:
-                    exp_avg_sq_hat = state['exp_avg_sq_hat']
+                        # Factored parameters only track the maxima of
+                        # their row and column statistics.
+                        if is_factored:
+                            state['exp_avg_sq_R_hat'] = torch.zeros_like(
+                                state['exp_avg_sq_R'])
+                            state['exp_avg_sq_C_hat'] = torch.zeros_like(
+                                state['exp_avg_sq_C'])
+                        else:
+                            state['exp_avg_sq_hat'] = \
+                                torch.zeros(new_shape, dtype=torch.float32,
+                                            device=p.grad.device)
 
                 state['step'] += 1
-                lr_t = group['lr']
-                lr_t *= max(group['eps2'], self._rms(p.data))
-
-                if group['enable_momentum']:
-                    if group['non_constant_decay']:
-                        beta1_t = group['beta1'] * \
-                                  (1 - group['beta1'] ** (state['step'] - 1)) \
-                                  / (1 - group['beta1'] ** state['step'])
-                    else:
-                        beta1_t = group['beta1']
-                    exp_avg.mul_(beta1_t).add_(1 - beta1_t, grad)
+                buckets.setdefault((state['step'], is_factored), []) \
+                    .append((p, grad))
 
-                if group['non_constant_decay']:
-                    beta2_t = group['beta2'] * \
-                              (1 - group['beta2'] ** (state['step'] - 1)) / \
-                              (1 - group['beta2'] ** state['step'])
-                else:
-                    beta2_t = group['beta2']
-
-                if is_matrix and group['enable_factorization']:
-                    exp_avg_sq_r.mul_(beta2_t). \
-                        add_(1 - beta2_t, torch.sum(torch.mul(grad, grad).
-                                                    add_(group['eps1']),
-                                                    dim=0, keepdim=True))
-                    exp_avg_sq_c.mul_(beta2_t). \
-                        add_(1 - beta2_t, torch.sum(torch.mul(grad, grad).
-                                                    add_(group['eps1']),
-                                                    dim=1, keepdim=True))
-                    v = torch.mul(exp_avg_sq_c,
-                                  exp_avg_sq_r).div_(torch.sum(exp_avg_sq_r))
-                else:
-                    exp_avg_sq.mul_(beta2_t). \
-                        addcmul_(1 - beta2_t, grad, grad). \
-                        add_((1 - beta2_t)*group['eps1'])
-                    v = exp_avg_sq
-
-                g = grad
-                if group['enable_momentum']:
-                    g = torch.div(exp_avg, 1 - beta1_t ** state['step'])
-
-                if group['ams_grad']:
-                    torch.max(exp_avg_sq_hat, v, out=exp_avg_sq_hat)
-                    v = exp_avg_sq_hat
-                    u = torch.div(g, (torch.div(v, 1 - beta2_t **
-                                  state['step'])).sqrt().add_(group['eps1']))
-                else:
-                    u = torch.div(g, v.sqrt())
+            for (step, is_factored), bucket in buckets.items():
+                self._step_bucket(group, step, is_factored, bucket)
 
-                u.div_(max(1, self._rms(u) / group['cliping_threshold']))
-                p.data.add_(-lr_t * (u.view(old_shape) if is_need_reshape and
-                            group['enable_factorization'] else u))
+        return loss
 
-                if group['weight_decay'] != 0:
-                    p.data.add_(-group['weight_decay'] * lr_t, p.data)
+    def _step_bucket(self, group, step, is_factored, bucket):
+        beta1_t, beta2_t, bias_correction1, bias_correction2 = \
+            self._decay_rates(group, step)
+        states = [self.state[p] for p, _ in bucket]
+        grads = [grad for _, grad in bucket]
+
+        if group['enable_momentum']:
+            _multi_tensor_decay_([state['exp_avg'] for state in states],
+                                 grads, beta1_t)
+
+        if is_factored:
+            for state, grad in zip(states, grads):
+                g2 = torch.mul(grad, grad).add_(group['eps1'])
+                state['exp_avg_sq_R'].mul_(beta2_t). \
+                    add_(torch.sum(g2, dim=0, keepdim=True),
+                         alpha=1 - beta2_t)
+                state['exp_avg_sq_C'].mul_(beta2_t). \
+                    add_(torch.sum(g2, dim=1, keepdim=True),
+                         alpha=1 - beta2_t)
+        else:
+            _multi_tensor_decay_([state['exp_avg_sq'] for state in states],
+                                 grads, beta2_t, square=True,
+                                 eps=group['eps1'])
+
+        # Scripted functions do not accept ints for float arguments.
+        hparams = (float(group['lr']), float(group['eps2']),
+                   float(group['cliping_threshold']),
+                   float(group['weight_decay']))
+
+        for (p, grad), state in zip(bucket, states):
+            g = grad
+            if group['enable_momentum']:
+                g = torch.mul(state['exp_avg'], bias_correction1)
+
+            if not group['ams_grad']:
+                if is_factored:
+                    _adafactor_update_factored(
+                        p.data, g, state['exp_avg_sq_R'],
+                        state['exp_avg_sq_C'], *hparams)
+                else:
+                    _adafactor_update_dense(
+                        p.data, g, state['exp_avg_sq'], *hparams)
+                continue
 
-        return loss
+            if is_factored:
+                exp_avg_sq_r = torch.max(state['exp_avg_sq_R_hat'],
+                                         state['exp_avg_sq_R'],
+                                         out=state['exp_avg_sq_R_hat'])
+                exp_avg_sq_c = torch.max(state['exp_avg_sq_C_hat'],
+                                         state['exp_avg_sq_C'],
+                                         out=state['exp_avg_sq_C_hat'])
+                v = torch.mul(exp_avg_sq_c,
+                              exp_avg_sq_r).div_(torch.sum(exp_avg_sq_r))
+            else:
+                v = torch.max(state['exp_avg_sq_hat'], state['exp_avg_sq'],
+                              out=state['exp_avg_sq_hat'])
+            u = torch.div(g, (torch.mul(v, bias_correction2))
+                          .sqrt().add_(group['eps1']))
+            _adafactor_apply(p.data, u, *hparams)